@@ -16,14 +16,22 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import argparse
-import csv
 import logging
+import os
 import re
 import sys
+import threading
 
 from datetime import date, datetime, timedelta
-from subprocess import run, TimeoutExpired, PIPE
-from typing import Match, Union, Tuple
+from functools import lru_cache
+from subprocess import run, Popen, CalledProcessError, TimeoutExpired, PIPE
+from typing import Iterator, Optional, Tuple
+
+try:
+    import dnf
+    import hawkey
+except ImportError:
+    dnf = None
 
 __license__ = "GPLv3"
 __version__ = "0.1"
@@ -39,6 +47,20 @@ DEBUG = False
 # Global logging object
 logger = logging.getLogger(__name__)
 
+# Precompiled patterns for parsing yum output
+# Line format: <advisory id> <severity>/Sec. <package>
+_RE_SEVERITY = re.compile(r"^(\S+)\s+(Critical|Important|Moderate|Low)/Sec\.\s+(\S+)")
+_RE_KERNEL = re.compile(r"/Sec\.\s*(kernel.*)")
+
+# Days until patch has to be installed, per severity
+_DAYS_LIMIT = {"Critical": 30, "Important": 90, "Moderate": 90, "Low": 90}
+
+
+@lru_cache(maxsize=512)
+def parse_date(value: str) -> date:
+    """Parse patch release date from yum updateinfo output (errata often share it)"""
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").date()
+
 
 def parseargs() -> argparse.Namespace:
     """ Parse command-line arguments """
@@ -107,214 +129,356 @@ class Updates:
         self.nokernel = nokernel
         self.next_patchdate = None
         self.expired = False
-
-    def run(self, cmd: list, verbose: bool=False):
-        """List security updates and return result"""
-        output = ""
-
+        self._listed = set()
+        self._today = date.today()
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+        self._cache = {}
+        self._cache_mtime = None
         try:
-            logger.debug(f'Running OS command line: {cmd} ...')
-            process = run(cmd, check=True, timeout=60, stdout=PIPE)
-            self.rc = process.returncode
-            output = process.stdout.decode('utf-8').splitlines()
-        except (TimeoutExpired, ValueError) as e:
-            logger.warning(f'{e}')
-            sys.exit(UNKNOWN)
-        except FileNotFoundError as e:
-            logger.critical(f"CRITICAL: Missing program {cmd[0] if len(cmd) > 0 else ''} ({e})")
-            sys.exit(CRITICAL)
-        except Exception as e:
-            logger.critical(f'CRITICAL: {e}')
-            sys.exit(CRITICAL)
-
-        for line in output:
-            expiration_date = None
-            expired = None
-
-            # Omit kernel patches
-            m = re.search(r"/Sec.\s*(kernel.*)", line)
-            if m and self.nokernel:
-                if verbose:
-                    logger.info(f"Skipping {m.group(1)}")
-                continue
-
-            # Always warn about these packages
-            pkgs = "(firefox.*|chrom.*)"
-            m = re.search(f"\s*{pkgs}", line)
-            if m:
-                logger.debug(line)
-                self.critical["Critical/Sec.  " + m.group(0).strip()] = datetime.today().strftime("%Y-%m-%d")
-                continue
+            mtime = os.stat(self.cache_file).st_mtime_ns
+            self._cache = self.read_cache()
+            self._cache_mtime = mtime
+        except OSError:
+            pass
 
-            # Critical patches
-            m = re.search(r"Critical/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 30)
-                logger.debug(line)
-                self.critical[m.group(0)] = expiration_date
-
-            # Important patches
-            m = re.search(r"Important/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 90)
-                logger.debug(line)
-                self.important[m.group(0)] = expiration_date
-
-            # Moderate patches
-            m = re.search(r"Moderate/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 90)
-                logger.debug(line)
-                self.moderate[m.group(0)] = expiration_date
-
-            # Low patches
-            m = re.search(r"Low/Sec.\s*(.*)$", line)
-            if isinstance(m, Match):
-                (expired, expiration_date) = self.check_expired(line, 90)
-                logger.debug(line)
-                self.low[m.group(0)] = expiration_date
+    def run(self, cmd: Optional[list] = None, verbose: bool=False):
+        """List security updates and return result
 
-            if expired:
-                self.expired = True
+        Advisories are read through the dnf Python API if cmd is None,
+        otherwise from the output of cmd (yum updateinfo list)."""
+        self._today = date.today()
+        # Logging level does not change during a run
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+        lines = self.list_dnf() if cmd is None else self.list_yum(cmd)
 
-            if expiration_date:
-                if not self.next_patchdate:
-                    self.next_patchdate = expiration_date
-                else:
-                    if self.next_patchdate > expiration_date:
-                        self.next_patchdate = expiration_date
+        # Categorize patches first, expiration dates are calculated afterwards
+        found, pending = self.categorize(lines, verbose)
+        self.compute_expiration(found, pending)
 
         if verbose:
             # Critical
-            for patch_name, expiration_date in sorted(self.critical.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
+            for patch_name, expiration_date in sorted(self.critical.items(), key=lambda item: item[1] if item[1] is not None else self._today):
                 if expiration_date is None:
                     expiration_date = "-         "
                 logger.info(f"Patch until {expiration_date} {patch_name}")
             # Important
-            for patch_name, expiration_date in sorted(self.important.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
+            for patch_name, expiration_date in sorted(self.important.items(), key=lambda item: item[1] if item[1] is not None else self._today):
                 if expiration_date is None:
                     expiration_date = "-         "
                 logger.info(f"Patch until {expiration_date} {patch_name}")
             # Medium
-            for patch_name, expiration_date in sorted(self.moderate.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
+            for patch_name, expiration_date in sorted(self.moderate.items(), key=lambda item: item[1] if item[1] is not None else self._today):
                 if expiration_date is None:
                     expiration_date = "-         "
                 logger.info(f"Patch until {expiration_date} {patch_name}")
             # Low
-            for patch_name, expiration_date in sorted(self.low.items(), key=lambda item: item[1] if item[1] is not None else datetime.today().date()):
+            for patch_name, expiration_date in sorted(self.low.items(), key=lambda item: item[1] if item[1] is not None else self._today):
                 if expiration_date is None:
                     expiration_date = "-         "
                 logger.info(f"Patch until {expiration_date} {patch_name}")
 
             logger.info(f"Next patch date: {self.next_patchdate}")
 
+    def categorize(self, lines: Iterator[str], verbose: bool=False) -> Tuple[list, list]:
+        """Sort security updates by severity
+
+        Returns the list of found patches and the list of patches whose
+        release date is not cached yet."""
+        # Patch list per severity
+        buckets = {
+            "Critical": self.critical,
+            "Important": self.important,
+            "Moderate": self.moderate,
+            "Low": self.low,
+        }
+
+        found = []
+        # Dict keeps insertion order for the yum arguments with O(1) lookups
+        pending = {}
+        for line in lines:
+            # Cheap literal tests before running any regex
+            is_security = "/Sec." in line
+
+            # Omit kernel patches
+            if is_security and self.nokernel:
+                m = _RE_KERNEL.search(line)
+                if m:
+                    if verbose:
+                        logger.info(f"Skipping {m.group(1)}")
+                    continue
+
+            # Always warn about these packages
+            if "firefox" in line or "chrom" in line:
+                start = min(i for i in (line.find("firefox"), line.find("chrom")) if i >= 0)
+                if self._debug:
+                    logger.debug(line)
+                self.critical["Critical/Sec.  " + line[start:].strip()] = self._today
+                continue
+
+            if not is_security:
+                continue
+
+            # Critical, important, moderate and low patches
+            m = _RE_SEVERITY.match(line)
+            if m:
+                patch, severity, package = m.group(1), m.group(2), m.group(3)
+                if self._debug:
+                    logger.debug(line)
+                found.append((buckets[severity], f"{severity}/Sec.  {package}", patch, _DAYS_LIMIT[severity]))
+                self._listed.add(patch)
+                if patch not in pending and not self.check_cache(patch)[0]:
+                    pending[patch] = None
+
+        return found, list(pending)
+
+    def compute_expiration(self, found: list, pending: list):
+        """Calculate expiration dates of found patches and the next patch date"""
+        # Retrieve release dates of all uncached patches at once
+        self.fetch_patch_dates(pending)
+
+        for patches, patch_name, patch, days_limit in found:
+            (expired, expiration_date) = self.check_expired(patch, days_limit)
+            patches[patch_name] = expiration_date
+
+            if expired:
+                self.expired = True
+
+            if expiration_date:
+                if not self.next_patchdate:
+                    self.next_patchdate = expiration_date
+                else:
+                    if self.next_patchdate > expiration_date:
+                        self.next_patchdate = expiration_date
+
+    def list_yum(self, cmd: list) -> Iterator[str]:
+        """Run yum and yield its output line by line"""
+        try:
+            logger.debug(f'Running OS command line: {cmd} ...')
+            process = Popen(cmd, stdout=PIPE, bufsize=1, universal_newlines=True, encoding='utf-8')
+        except ValueError as e:
+            logger.warning(f'{e}')
+            sys.exit(UNKNOWN)
+        except FileNotFoundError as e:
+            logger.critical(f"CRITICAL: Missing program {cmd[0] if len(cmd) > 0 else ''} ({e})")
+            sys.exit(CRITICAL)
+        except Exception as e:
+            logger.critical(f'CRITICAL: {e}')
+            sys.exit(CRITICAL)
+
+        # Kill yum if it does not finish in time (e.g. waiting for the yum lock),
+        # otherwise reading its output would block
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(60, kill)
+        timer.daemon = True
+
+        with process:
+            # Process output line by line while yum is still writing it
+            timer.start()
+            try:
+                for line in process.stdout:
+                    yield line.rstrip('\n')
+            finally:
+                timer.cancel()
+
+            try:
+                self.rc = process.wait()
+                if timed_out.is_set():
+                    raise TimeoutExpired(cmd, 60)
+                if self.rc != 0:
+                    raise CalledProcessError(self.rc, cmd)
+            except TimeoutExpired as e:
+                logger.warning(f'{e}')
+                sys.exit(UNKNOWN)
+            except Exception as e:
+                logger.critical(f'CRITICAL: {e}')
+                sys.exit(CRITICAL)
+
+    def list_dnf(self) -> Iterator[str]:
+        """Retrieve security advisories in-process with the dnf Python API
+
+        Yields lines in the format of yum updateinfo list. Release dates are
+        part of the advisory metadata and are stored in the in-memory cache
+        right away, so no yum updateinfo info lookups are needed."""
+        base = None
+        try:
+            logger.debug('Loading dnf repositories ...')
+            base = dnf.Base()
+            base.conf.read()
+            base.read_all_repos()
+            base.fill_sack()
+
+            listed = set()
+            installed = base.sack.query().installed()
+            for pkg in installed:
+                for advisory in pkg.get_advisories(hawkey.GT):
+                    if advisory.type != hawkey.ADVISORY_SECURITY:
+                        continue
+                    self._cache[advisory.id] = advisory.updated.date() if advisory.updated else None
+
+                    for apkg in advisory.packages:
+                        if apkg.name != pkg.name or apkg.arch != pkg.arch:
+                            continue
+                        # Skip if fixed already, e.g. by another installed kernel version
+                        if installed.filter(name=apkg.name, arch=apkg.arch, evr__gte=apkg.evr):
+                            continue
+                        line = f"{advisory.id} {advisory.severity}/Sec. {apkg.name}-{apkg.evr}.{apkg.arch}"
+                        if line not in listed:
+                            listed.add(line)
+                            yield line
+            self.rc = 0
+        except Exception as e:
+            logger.critical(f'CRITICAL: {e}')
+            sys.exit(CRITICAL)
+        finally:
+            if base is not None:
+                base.close()
+
     def create_output(self) -> Tuple[int, str]:
         """Verify result and return output in Nagios format"""
         if self.rc >= 0:
             result = OK
         else:
-            return UNKNOWN, f'{return_codes[UNKNOWN]}'
+            return UNKNOWN, return_codes[UNKNOWN]
 
-        if self.expired and (len(self.important) > 0 or len(self.moderate) > 0 or len(self.low) > 0):
+        # Number of patches per severity
+        critical, important, moderate, low = len(self.critical), len(self.important), len(self.moderate), len(self.low)
+
+        if self.expired and (important > 0 or moderate > 0 or low > 0):
             result = WARNING
-        if len(self.critical) > 0:
+        if critical > 0:
             result = CRITICAL
 
-        msg = f'{return_codes[result]}: Critical={len(self.critical)} Important={len(self.important)} ' \
-              f'Moderate={len(self.moderate)} Low={len(self.low)} next_patch_date={self.next_patchdate}'
-        perfdata = f'Critical={len(self.critical)};' \
-                   f'Important={len(self.important)};' \
-                   f'Moderate={len(self.moderate)};' \
-                   f'Low={len(self.low)};'
+        msg = f'{return_codes[result]}: Critical={critical} Important={important} ' \
+              f'Moderate={moderate} Low={low} next_patch_date={self.next_patchdate}'
+        perfdata = f'Critical={critical};' \
+                   f'Important={important};' \
+                   f'Moderate={moderate};' \
+                   f'Low={low};'
 
         message = f'{msg}|{perfdata}'
         logger.debug(message)
         return result, message
 
-    def check_expired(self, line:str, days_limit: int) -> Tuple[bool, Union[datetime.date,None]]:
+    def check_expired(self, patch:str, days_limit: int) -> Tuple[bool, Optional[date]]:
         """Check if time frame for update has expired"""
-        output = ""
         expiration_date = None
 
-        m = re.match(r"([^\s]+)\s", line)
-        if m:
-            logger.debug(f"{line}")
-            patch = m.group(0).strip()
-
-            # Check if patch is already in local cache
+        # Check if patch is already in local cache
+        is_cached, patch_date = self.check_cache(patch)
+        if not is_cached:
+            # Retrieve patch info online
+            self.fetch_patch_dates([patch])
             is_cached, patch_date = self.check_cache(patch)
-            if is_cached:
-                logger.debug(f"Local cache: {patch} {patch_date}")
-            else:
-                # Retrieve patch info online
-                cmd = ["yum", "updateinfo", "info", f"{patch}"]
-                try:
-                    logger.debug(f'Running OS command line: {cmd} ...')
-                    process = run(cmd, check=True, timeout=60, stdout=PIPE)
-                    self.rc = process.returncode
-                    output = process.stdout.decode('utf-8').splitlines()
-                except (TimeoutExpired, ValueError) as e:
-                    logger.warning(f'{e}')
-                    sys.exit(UNKNOWN)
-                except FileNotFoundError as e:
-                    logger.critical(f"CRITICAL: Missing program {cmd[0] if len(cmd) > 0 else ''} ({e})")
-                    sys.exit(CRITICAL)
-                except Exception as e:
-                    logger.critical(f'CRITICAL: {e}')
-                    sys.exit(CRITICAL)
-    
-                # Write patch date to cache file
-                m2 = None
-                for info_line in output:
-                    #logger.debug(f"{info_line}")
-                    m2 = re.match(r"\s*(Updated|Issued)\s*:\s*(\d+-\d+-\d+ \d+:\d+:\d+)", info_line)
-                    if m2:
-                        patch_date = datetime.strptime(m2.group(2), "%Y-%m-%d %H:%M:%S").date()
-                        if self.update_cache(patch, patch_date):
-                            logger.debug(f"Local cache updated: {patch} {patch_date}")
-                        break
-
-                if m2 is None:
-                    if self.update_cache(patch, None):
-                        logger.debug(f"Local cache updated: {patch} None")
-
-            # Calculate expiration date after which patch has to be installed
-            if patch_date is not None:
-                expiration_date = patch_date + timedelta(days_limit)
-                if date.today() >= expiration_date:
+        if is_cached and self._debug:
+            logger.debug(f"Local cache: {patch} {patch_date}")
+
+        # Calculate expiration date after which patch has to be installed
+        if patch_date is not None:
+            expiration_date = patch_date + timedelta(days_limit)
+            if self._today >= expiration_date:
+                if self._debug:
                     logger.debug(f"Timeframe to patch has expired: {expiration_date} (more than {days_limit} days ago)")
-                    return True, expiration_date
-                else:
-                    logger.debug(f"patch_date={patch_date} days_limit={days_limit} (patch before {patch_date + timedelta(days_limit)})")
-        else:
-            logger.error(f"Patch line has wrong format: {line}")
+                return True, expiration_date
+            elif self._debug:
+                logger.debug(f"patch_date={patch_date} days_limit={days_limit} (patch before {patch_date + timedelta(days_limit)})")
 
         return False, expiration_date
 
-    def check_cache(self, patch:str) -> Tuple[bool, Union[datetime.date, None]]:
-        '''Check local cache for patch release date'''
+    def fetch_patch_dates(self, patches: list):
+        """Retrieve release dates of patches online and write them to local cache"""
+        output = ""
+
+        if not patches:
+            return
+
+        # Query all patches with a single yum call. Parallel yum processes
+        # would only block each other on the yum lock.
+        cmd = ["yum", "updateinfo", "info"] + patches
         try:
-            with open(self.cache_file) as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=',')
-                for row in csv_reader:
-                    if row[0] == patch:
-                        if row[1] != "None":
-                            return (True, datetime.strptime(row[1], "%Y-%m-%d").date())
-                        else:
-                            return (True, None)
-        except Exception:
-            pass
+            logger.debug(f'Running OS command line: {cmd} ...')
+            process = run(cmd, check=True, timeout=60, stdout=PIPE, universal_newlines=True, encoding='utf-8')
+            self.rc = process.returncode
+            output = process.stdout.splitlines()
+        except (TimeoutExpired, ValueError) as e:
+            logger.warning(f'{e}')
+            sys.exit(UNKNOWN)
+        except FileNotFoundError as e:
+            logger.critical(f"CRITICAL: Missing program {cmd[0] if len(cmd) > 0 else ''} ({e})")
+            sys.exit(CRITICAL)
+        except Exception as e:
+            logger.critical(f'CRITICAL: {e}')
+            sys.exit(CRITICAL)
+
+        # Output contains one block per advisory, starting with its update id
+        patch_dates = {}
+        patch = None
+        for info_line in output:
+            # Fields are formatted as "<key> : <value>"
+            key, sep, value = info_line.partition(":")
+            if not sep:
+                continue
+            key = key.strip()
+
+            if key == "Update ID":
+                patch = value.strip()
+            elif key in ("Updated", "Issued") and patch is not None and patch not in patch_dates:
+                try:
+                    patch_dates[patch] = parse_date(value.strip())
+                except ValueError:
+                    pass
+
+        # Write patch dates to cache file
+        patch_dates = {patch: patch_dates.get(patch) for patch in patches}
+        if self.update_cache(patch_dates) and self._debug:
+            for patch, patch_date in patch_dates.items():
+                logger.debug(f"Local cache updated: {patch} {patch_date}")
+
+    def read_cache(self) -> dict:
+        '''Read patch release dates from local cache file'''
+        cache = {}
+
+        # One patch per line: <patch name> <YYYY-MM-DD|None>
+        with open(self.cache_file) as cache_file:
+            for line in cache_file:
+                try:
+                    patch_name, patch_date = line.split()
+                    if patch_name not in cache:
+                        cache[patch_name] = datetime.strptime(patch_date, "%Y-%m-%d").date() if patch_date != "None" else None
+                except ValueError:
+                    pass
+
+        return cache
+
+    def check_cache(self, patch:str) -> Tuple[bool, Optional[date]]:
+        '''Check local cache for patch release date'''
+        if patch in self._cache:
+            return (True, self._cache[patch])
 
         return (False, None)
 
-    def update_cache(self, patch:str, patch_date: Union[datetime.date, None]) -> bool:
-        '''Insert patch release date in local cache'''
-        patch_date_str = patch_date.strftime("%Y-%m-%d") if patch_date else "None"
+    def cache_changed(self) -> bool:
+        '''Check if cache file was modified since it was last read or written by us'''
+        try:
+            return os.stat(self.cache_file).st_mtime_ns != self._cache_mtime
+        except OSError:
+            return self._cache_mtime is not None
+
+    def update_cache(self, patch_dates: dict) -> bool:
+        '''Insert patch release dates in local cache'''
+        in_sync = not self.cache_changed()
+        self._cache.update(patch_dates)
 
         try:
-            with open(self.cache_file, mode='a') as csv_file:
-                patch_writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                patch_writer.writerow([patch, patch_date_str])
+            with open(self.cache_file, mode='a') as cache_file:
+                cache_file.writelines(f"{patch} {patch_date.isoformat() if patch_date else 'None'}\n"
+                                      for patch, patch_date in patch_dates.items())
+            if in_sync:
+                self._cache_mtime = os.stat(self.cache_file).st_mtime_ns
         except Exception as e:
             logger.error(f"Error writing cache file {self.cache_file}: {e}")
             return False
@@ -325,30 +489,24 @@ class Updates:
         '''Delete patch information from cache file that is older than 1 year'''
         patches = {}
 
-        # Read cache file
+        # Read cache file, unless the in-memory cache is still up to date
         try:
-            with open(self.cache_file) as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=',', fieldnames=['patch_name', 'patch_date'])
-                for row in csv_reader:
-                    patches[row['patch_name']] = row['patch_date']
+            patches = self.read_cache() if self.cache_changed() else self._cache
         except Exception as e:
             logger.error(f"Read error while cleaning cache file {self.cache_file}: {e}")
             return False
 
         # Write new cache file, sorted by patch date (newest first)
-        # Patches older than 1 year are ignored
+        # Patches older than 1 year are ignored, unless they are still not installed
+        today = self._today
         try:
-            with open(self.cache_file, mode='w') as csv_file:
-                patch_writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                for patch_name, patch_date in sorted(patches.items(), key=lambda kv: kv[1] if kv[1] is not None else datetime.today().date(), reverse=True):
-                    try:
-                        dx = datetime.today() - datetime.strptime(patch_date, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        dx = timedelta(0)
-
-                    if dx.days < 365:
-                        patch_writer.writerow([patch_name, patch_date])
-                    else:
+            with open(self.cache_file, mode='w') as cache_file:
+                for patch_name, patch_date in sorted(patches.items(), key=lambda kv: kv[1] if kv[1] is not None else today, reverse=True):
+                    dx = today - patch_date if patch_date is not None else timedelta(0)
+
+                    if dx.days < 365 or patch_name in self._listed:
+                        cache_file.write(f"{patch_name} {patch_date.isoformat() if patch_date else 'None'}\n")
+                    elif self._debug:
                         logger.debug(f"Removing from cache file: {patch_name} {patch_date}")
         except Exception as e:
             logger.error(f"Write error while cleaning cache file {self.cache_file}: {e}")
@@ -398,14 +556,16 @@ def main():
 
     # Retrieve list of available Linux updates
     updates = Updates(args.cache, True if args.nokernel else False)
-    updates.run(['yum', 'updateinfo', 'list'], args.verbose)
+    # Prefer the dnf Python API (RHEL >= 8), fall back to the yum command line
+    cmd = None if dnf is not None else ['yum', 'updateinfo', 'list']
+    updates.run(cmd, args.verbose)
     result, message = updates.create_output()
     print(message)
 
     # Clean old entries from cache file
     updates.clean_cache()
 
-    exit(result)
+    sys.exit(result)
 
 
 if __name__ == '__main__':